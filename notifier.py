@@ -3,8 +3,25 @@
 
 import configparser
 import argparse
-import nexmo
-import pandas
+import concurrent.futures
+import json
+import re
+import sys
+import threading
+import time
+
+NEXMO_SMS_URL = 'https://rest.nexmo.com/sms/json'
+
+# E.164 allows at most 15 digits, anything shorter than 8 is not a number
+PHONE_PATTERN = re.compile(r'\d{8,15}')
+
+# calling codes of the most common destinations, longest first so that
+# the first match is the most specific one
+COUNTRY_CODES = sorted(('1', '7', '20', '27', '30', '31', '32', '33', '34',
+                        '36', '39', '41', '43', '44', '45', '46', '47', '48',
+                        '49', '52', '55', '61', '81', '82', '86', '90', '91',
+                        '351', '353', '358', '971'),
+                       key=len, reverse=True)
 
 class Notify(object):
     """
@@ -16,7 +33,6 @@ class Notify(object):
 
     Attributes:
 
-        nexmo (obj) : provider's object
         api_key (str) : Nexmo's API KEY
         api_secret (str) : Nexmo's API secret
         sender (str) : Sender's name
@@ -25,43 +41,174 @@ class Notify(object):
         smtp_pwd (str) : email's user password
         smtp_server (str) : smtp server location
         smtp_port (int) : smtp port
+        smtp_max_msgs (int) : messages sent before reconnecting
 
         clients ([]) : list of clients
+        _phones, _countries ([]) : clients' send fields, by index
+        buckets ({}) : rate limiters per destination country
 
     """
     def __init__(self, sender, api_key, api_secret,
                        fromaddr, smtp_pwd, smtp_server, smtp_port):
         super(Notify, self).__init__()
-        self.nexmo = nexmo.Client(key=api_key, secret=api_secret)
         self.api_key = api_key
         self.api_secret = api_secret
         self.sender = sender
 
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # keeps the connections to Nexmo alive across requests
+        self._http = requests.Session()
+        self._http.mount('https://', HTTPAdapter(pool_connections=10,
+                                                 pool_maxsize=32))
+
 
         self.fromaddr = fromaddr
         self.smtp_pwd = smtp_pwd
         self.smtp_server =smtp_server
         self.smtp_port = smtp_port
+        self.smtp_max_msgs = 100
+        self._smtp = None
+        self._smtp_msgs = 0
 
         self.clients = list()
+        self._index()
+
+        self._wb = None
+        self._wb_path = None
 
-    def push_sms(self, content):
+        # keyed by country calling code, Nexmo allows 30 sms/s overall
+        # (default, shared by all sends) and 1 sms/s towards US/CA (+1)
+        self.buckets = {'default': TokenBucket(rate=30, capacity=30),
+                        '1': TokenBucket(rate=1, capacity=1)}
+
+    def push_sms(self, content, concurrency=10):
         """
         Pushes sms to contact list
 
+        The requests are I/O bound, hence they are dispatched from a
+        pool of worker threads, with at most concurrency requests
+        in flight at any given time.
+
+        A send that fails is recorded as an error response for its
+        client, the remaining clients are still sent their sms.
+        Clients with an invalid phone number are not sent one.
+
         Args:
             content (str) : SMS content
+            concurrency (int) : maximum number of simultaneous requests
 
         """
 
         if not self.clients:
             return
 
-        for client in self.clients:
-            response = self.nexmo.send_message({'from': self.sender,
-                                            'to': '{0}'.format(client.phone),
-                                            'text': content})
-            client.sms = response
+        import requests
+
+        self._index()
+
+        # only the destination changes between requests
+        base = {'from': self.sender,
+                'text': content,
+                'api_key': self.api_key,
+                'api_secret': self.api_secret}
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=concurrency) as executor:
+            futures = {executor.submit(self._send_one, i, base): i
+                       for i, client in enumerate(self.clients)
+                       if client.phone_valid}
+
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    client = self.clients[futures[future]]
+                    try:
+                        client.sms = future.result()
+                    except requests.RequestException as error:
+                        client.sms = error_response('5', error)
+            except BaseException:
+                # sends that have not started yet are dropped
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _index(self):
+        """
+        Lays out the clients' send fields as parallel columns
+
+        The send workers only need the destination of each client,
+        which they read by index from these columns. The responses
+        are stored back on the clients.
+
+        """
+        self._phones = [client.phone_e164 for client in self.clients]
+        self._countries = [client.country for client in self.clients]
+
+    def _send_one(self, i, base):
+        """
+        Sends a single sms and returns the provider's response
+
+        Args:
+            i (int) : index of the sms recipient
+            base (dict) : request parameters shared by all recipients
+
+        """
+        # every sms counts towards the overall limit, some destinations
+        # also have a stricter one of their own
+        buckets = [self.buckets['default']]
+        if self._countries[i] in self.buckets:
+            buckets.insert(0, self.buckets[self._countries[i]])
+
+        # requests run concurrently, hence each gets its own copy
+        return self._send_with_retry(dict(base, to=self._phones[i]), buckets)
+
+    def _send_with_retry(self, payload, buckets,
+                         max_attempts=3, base=0.5, cap=8):
+        """
+        Sends an sms, retrying transient failures
+
+        Throttled responses and failures to connect are retried
+        with an exponential backoff. After max_attempts the last
+        response is returned, or the last error is raised.
+
+        Any other error is raised straight away, as it may happen
+        after Nexmo accepted the sms and retrying would deliver it
+        twice. This includes read timeouts, server errors and
+        connections dropped while the request was being sent.
+
+        Args:
+            payload (dict) : Nexmo's SMS API parameters
+            buckets ([TokenBucket]) : rate limiters for the destination
+            max_attempts (int) : maximum number of requests
+            base (float) : initial backoff in seconds
+            cap (float) : maximum backoff in seconds
+
+        """
+        import requests
+
+        for attempt in range(max_attempts):
+            last = attempt == max_attempts - 1
+            for bucket in buckets:
+                bucket.acquire()
+
+            try:
+                reply = self._http.post(NEXMO_SMS_URL,
+                                        data=payload,
+                                        timeout=30)
+                reply.raise_for_status()
+            except requests.ConnectionError as error:
+                if last or not connect_failed(error):
+                    raise
+            except requests.HTTPError:
+                if last or reply.status_code != 429:
+                    raise
+            else:
+                response = reply.json()
+                if last or not is_retryable(response):
+                    return response
+
+            time.sleep(min(cap, base * 2 ** attempt))
 
 
     def build_release_content(self, title, body):
@@ -97,7 +244,8 @@ class Notify(object):
         """
         Send confirmation email
 
-        Loops through the SMS answers and sends out an email
+        Splits the clients by their SMS answer and sends out
+        the matching email to each of them
 
         Args:
             subject (str) : email's subject
@@ -106,65 +254,247 @@ class Notify(object):
 
         """
 
-        import smtplib
         from email.message import EmailMessage
 
-        # Send the message via a remote SMTP server
-        server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-        server.ehlo()
-        server.starttls()
-        server.login(self.fromaddr, self.smtp_pwd)
+        # clients that were not sent an sms get the success email
+        ok, err = list(), list()
+        for client in self.clients:
+            if client.sms is None or sms_status(client.sms) == 0:
+                ok.append(client)
+            else:
+                err.append(client)
 
-        if self.clients:
-            for client in self.clients:
+        for body, batch in ((in_success, ok), (in_error, err)):
+            if not batch:
+                continue
 
-                msg = EmailMessage()
-                msg['Subject'] = subject
-                msg['From'] = self.fromaddr
+            # only the recipient changes between emails
+            msg = EmailMessage()
+            msg['Subject'] = subject
+            msg['From'] = self.fromaddr
+            msg.set_content(body)
 
-                if client.sms is None:
-                    body = in_success
+            for client in batch:
+                # assigning a header appends it, the old one must go first
+                del msg['To']
+                msg['To'] = client.email
 
-                elif client.sms['messages'][0]['status'] == 0:
-                    body = in_success
+                self._smtp_send(msg)
 
-                else:
-                    body = in_error
+    def _smtp_conn(self):
+        """
+        Returns a logged in SMTP connection
 
-                msg['To'] = client.email
-                msg.set_content(body)
+        The connection is kept open across calls and is only
+        reestablished after smtp_max_msgs messages have been
+        sent through it, or once the server drops it
+
+        """
+        import smtplib
+
+        if self._smtp is not None and self._smtp_msgs >= self.smtp_max_msgs:
+            self._smtp_close()
+
+        if self._smtp is None:
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port)
+            server.ehlo()
+            server.starttls()
+            server.login(self.fromaddr, self.smtp_pwd)
+            self._smtp = server
+            self._smtp_msgs = 0
 
-                server.send_message(msg)
+        return self._smtp
 
-        server.quit()
+    def _smtp_send(self, msg):
+        """
+        Sends an email through the shared SMTP connection
+
+        If the server dropped the connection or timed it out (421)
+        before the message data was sent, it is reestablished and
+        the email sent again. Failures after that are raised, as
+        the server may have accepted the email already.
+
+        Args:
+            msg (EmailMessage) : email to send
+
+        """
+        import smtplib
+
+        for attempt in range(2):
+            server = self._smtp_conn()
+            try:
+                code, reply = server.mail(self.fromaddr)
+                if code == 250:
+                    code, reply = server.rcpt(msg['To'])
+            except smtplib.SMTPServerDisconnected:
+                code, reply = 421, b'Connection closed'
+
+            if code != 421 or attempt:
+                break
+
+            # nothing was sent yet, it is safe to try again
+            self._smtp_drop()
+
+        if code not in (250, 251):
+            self._smtp_abort(code)
+            raise smtplib.SMTPResponseException(code, reply)
+
+        try:
+            code, reply = server.data(
+                msg.as_bytes(policy=msg.policy.clone(linesep='\r\n')))
+        except smtplib.SMTPDataError as error:
+            code, reply = error.smtp_code, error.smtp_error
+
+        if code != 250:
+            self._smtp_abort(code)
+            raise smtplib.SMTPDataError(code, reply)
+
+        self._smtp_msgs += 1
+
+    def _smtp_abort(self, code):
+        """
+        Resets the SMTP session after a refused command
+
+        Args:
+            code (int) : server's reply code, on 421 the server is
+                         closing the connection so it is dropped
+
+        """
+        import smtplib
+
+        if code == 421:
+            self._smtp_drop()
+            return
 
+        try:
+            self._smtp.rset()
+        except smtplib.SMTPServerDisconnected:
+            self._smtp_drop()
 
-    def parser(self, filepath):
+    def _smtp_drop(self):
+        """
+        Discards an SMTP connection the server already closed
+        """
+        self._smtp.close()
+        self._smtp = None
+
+    def _smtp_close(self):
+        """
+        Closes the SMTP connection, if any
+        """
+        import smtplib
+
+        if self._smtp is None:
+            return
+
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        finally:
+            self._smtp = None
+
+    def close(self):
+        """
+        Releases the connections and files held by the notifier
+        """
+        self._http.close()
+        self._smtp_close()
+        self._close_workbook()
+
+    def parser(self, filepath, sheet=0):
         """
         Parse xlsx
 
         Reads an excel list with the following format
 
-        First Name | Surname | Phone
+        Name | Surname | Phone | Email
 
         Creates and stores an object representation for each client
 
         Args:
             filepath (str) : filepath for xls file
+            sheet (int/str) : sheet's index or name
 
 
         """
-        wb = pandas.read_excel(filepath)
+        self._open(filepath)
+        self._parse_sheet(sheet)
 
-        for idx, row in wb.iterrows():
-            try:
-                self.clients.append(Client(row['Name'],
-                                       row['Surname'],
-                                       row['Phone'],
-                                       row['Email']))
-            except:
-                raise KeyError('Please check xlsx content')
+    def _open(self, filepath):
+        """
+        Opens a workbook, reusing it if it is already open
+
+        Loading parses the shared strings table, which is then
+        shared by all the sheets read from the same file
+
+        Args:
+            filepath (str) : filepath for xls file
+
+        """
+        if self._wb is not None and self._wb_path == filepath:
+            return
+
+        import openpyxl
 
+        self._close_workbook()
+        self._wb = openpyxl.load_workbook(filepath,
+                                          read_only=True,
+                                          data_only=True)
+        self._wb_path = filepath
+
+    def _parse_sheet(self, sheet):
+        """
+        Creates a client for each row of a sheet of the open workbook
+
+        Rows with an invalid phone number are reported, their
+        clients are kept so that they still get the error email
+
+        Args:
+            sheet (int/str) : sheet's index or name
+
+        """
+        if isinstance(sheet, int):
+            ws = self._wb.worksheets[sheet]
+        else:
+            ws = self._wb[sheet]
+
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, ())
+        idx = {column: i for i, column in enumerate(header)}
+
+        columns = ('Name', 'Surname', 'Phone', 'Email')
+        missing = [column for column in columns if column not in idx]
+        if missing:
+            raise KeyError('Please check xlsx content, missing columns: {0}'
+                           .format(', '.join(missing)))
+
+        name, surname, phone, email = (idx[column] for column in columns)
+
+        # the header is the first row
+        for number, row in enumerate(rows, start=2):
+            if not any(row):
+                continue
+
+            client = Client(row[name], row[surname], row[phone], row[email])
+
+            if not client.phone_valid:
+                print('Row {0} has an invalid phone number, no sms will '
+                      'be sent: {1}'.format(number, row[phone]),
+                      file=sys.stderr)
+
+            self.clients.append(client)
+
+    def _close_workbook(self):
+        """
+        Closes the open workbook, if any
+        """
+        if self._wb is None:
+            return
+
+        self._wb.close()
+        self._wb = None
+        self._wb_path = None
 
     def print_response(self):
         """
@@ -174,12 +504,14 @@ class Notify(object):
         latest messages that where sent
 
         """
-        for client in self.clients:
-            if client.sms:
-                response = client.sms['messages']
-                print('{{{{"client", "{0}"}},"status":{1}}}'.format(client, response))
-            else:
-                print('{{{{"client", "{0}"}},"status":{1}}}'.format(client, None))
+        if not self.clients:
+            return
+
+        print('\n'.join(json.dumps({'client': str(client),
+                                    'status': client.sms['messages']
+                                              if client.sms else None},
+                                   default=str)
+                        for client in self.clients))
 
 
 class Client(object):
@@ -189,8 +521,17 @@ class Client(object):
         firstname (str) : Contact's firstname
         surname (str) : Contact's surname
         phone (str): Contact's phonenumber
+        phone_e164 (str): Contact's phonenumber digits, without the +
+        country (str): Contact's country calling code, if known
+        phone_valid (bool): If the phonenumber can be sent an sms
+        email (str): Contact's email
+        sms (dict): Provider's response to the latest sms, or the
+                    reason why none can be sent
 
     """
+    __slots__ = ('firstname', 'surname', 'phone', 'phone_e164', 'country',
+                 'phone_valid', 'email', 'sms')
+
     def __init__(self, firstname, surname, phone, email=None):
         super(Client, self).__init__()
         self.firstname =  firstname
@@ -199,6 +540,19 @@ class Client(object):
         self.email = email
         self.sms = None
 
+        # excel stores numbers as floats
+        if isinstance(phone, float) and phone.is_integer():
+            phone = int(phone)
+
+        self.phone_e164 = re.sub(r'\D', '', '{0}'.format(phone))
+        self.country = next((code for code in COUNTRY_CODES
+                             if self.phone_e164.startswith(code)), None)
+
+        # rejected here rather than by Nexmo, after a round trip
+        self.phone_valid = PHONE_PATTERN.fullmatch(self.phone_e164) is not None
+        if not self.phone_valid:
+            self.sms = error_response('3', 'Invalid phone number')
+
     def __str__(self):
         return ('{0} {1} {2}'.format(self.firstname,
                                       self.surname,
@@ -209,16 +563,140 @@ class Client(object):
         return self.__str__()
 
 
-def user_inputs():
+class TokenBucket(object):
+    """Token bucket rate limiter
+
+        Tokens are refilled continuously at rate per second, up to
+        capacity. Each acquire consumes one token, blocking until one
+        is available. It is safe to share across threads.
+
+        Attributes:
+        rate (float) : tokens added per second
+        capacity (float) : maximum number of tokens
+        tokens (float) : tokens currently available
+        last (float) : time of the last refill
+
+    """
+    def __init__(self, rate, capacity):
+        super(TokenBucket, self).__init__()
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes one token, waiting for it to be refilled if needed
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--configuration', default='details.ini', type=str)
-    parser.add_argument('--destination', default=None, type=str)
-    parser.add_argument('--email', default=None, type=str)
-    parser.add_argument('--skip_sms', default=None, action='store_true')
-    args = parser.parse_args()
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.last = time.monotonic()
+                self.tokens = 1
 
-    return args
+            self.tokens -= 1
+
+
+def sms_status(response):
+    """
+    Returns the status code of an sms, 0 if Nexmo accepted it
+
+    Args:
+        response (dict) : Nexmo's SMS API response
+
+    """
+    return int(response['messages'][0]['status'])
+
+
+def error_response(status, reason):
+    """
+    Builds a Nexmo-like response for an sms that was not accepted
+
+    Args:
+        status (str) : Nexmo's status code that best describes it
+        reason (obj) : error or text explaining the failure
+
+    """
+    return {'messages': [{'status': status,
+                          'error-text': '{0}'.format(reason)}]}
+
+
+def connect_failed(error):
+    """
+    Tells if a request failed before it was sent
+
+    Covers connect timeouts and refused or unresolved connections,
+    but not connections that were dropped after being established
+
+    Args:
+        error (requests.ConnectionError) : error raised by the request
+
+    """
+    import requests
+    from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+
+    cause = error.args[0] if error.args else None
+    if isinstance(cause, MaxRetryError):
+        cause = cause.reason
+
+    return isinstance(cause, NewConnectionError)
+
+
+def is_retryable(response):
+    """
+    Tells if a Nexmo response failed due to throttling
+
+    Args:
+        response (dict) : Nexmo's SMS API response
+
+    """
+    message = response['messages'][0]
+    if '{0}'.format(message['status']) in ('1', '429'):
+        return True
+
+    error = message.get('error-text', '').lower()
+    return any(reason in error for reason in ('rate limit',
+                                              'quota',
+                                              'throughput'))
+
+
+def require(cfg, section, key, message):
+    """
+    Reads a mandatory configuration option
+
+    Args:
+        cfg (dict) : configuration options, by section
+        section (str) : option's section
+        key (str) : option's lowercase name
+        message (str) : error message if the option is missing
+
+    """
+    options = cfg.get(section, {})
+    if key not in options:
+        raise KeyError(message)
+
+    return options[key]
+
+
+_PARSER = argparse.ArgumentParser()
+_PARSER.add_argument('--configuration', default='details.ini', type=str)
+_PARSER.add_argument('--destination', default=None, type=str)
+_PARSER.add_argument('--email', default=None, type=str)
+_PARSER.add_argument('--skip_sms', default=None, action='store_true')
+
+
+def user_inputs():
+
+    return _PARSER.parse_args()
 
 
 if __name__ == "__main__":
@@ -230,57 +708,36 @@ if __name__ == "__main__":
     config = configparser.ConfigParser()
     config.read(args.configuration)
 
+    # options are looked up once, configparser lowercases their names
+    cfg = {section: dict(config[section]) for section in config.sections()}
+    sms = cfg.get('SMS', {})
+    email = cfg.get('EMAIL', {})
 
     # validate fields
-    try:
-        sender = config.get('SMS','SENDER')
-        api_key = config.get('NEXMO','API_KEY')
-        api_secret = config.get('NEXMO','API_SECRET')
-    except:
-        raise KeyError('Missing NEXMO details')
+    sender = require(cfg, 'SMS', 'sender', 'Missing NEXMO details')
+    api_key = require(cfg, 'NEXMO', 'api_key', 'Missing NEXMO details')
+    api_secret = require(cfg, 'NEXMO', 'api_secret', 'Missing NEXMO details')
 
-    try:
-        destination = config.get('SMS','DESTINATION')
-    except:
-        if args.destination is None:
-            raise KeyError('Please enter a valid destination')
+    destination = sms.get('destination')
+    if destination is None and args.destination is None:
+        raise KeyError('Please enter a valid destination')
 
-    try:
-        sms_content = config.get('SMS','CONTENT')
-    except:
-        raise KeyError('Missing SMS content')
+    sms_content = require(cfg, 'SMS', 'content', 'Missing SMS content')
 
-    try:
-        fromaddr = config.get('EMAIL','SENDER')
-        smtp_pwd = config.get('EMAIL','PASSWORD')
-    except:
-        raise KeyError('Missing EMAIL details (FROM and PASSWORD)')
-
-    try:
-        smtp_server = config.get('EMAIL','SMTP')
-    except:
-        smtp_server = 'smtp.office365.com'
+    fromaddr = require(cfg, 'EMAIL', 'sender',
+                       'Missing EMAIL details (FROM and PASSWORD)')
+    smtp_pwd = require(cfg, 'EMAIL', 'password',
+                       'Missing EMAIL details (FROM and PASSWORD)')
 
-    try:
-        smtp_port = int(config.get('EMAIL','PORT'))
-    except:
-        smtp_port = 587
+    smtp_server = email.get('smtp', 'smtp.office365.com')
+    smtp_port = int(email.get('port', 587))
 
     # email confirmation details
-    try:
-        subject = config.get('SUBJECT')
-    except:
-        subject = 'Email notification'
-
-    try:
-        in_success=config.get('SUCCESS')
-    except:
-        in_success = 'We have sent you an SMS, please check your phone!'
-
-    try:
-        in_error=config.get('ERROR')
-    except:
-        in_error = 'We could not reach you by SMS, please get in touch with us!'
+    subject = email.get('subject', 'Email notification')
+    in_success = email.get('success',
+        'We have sent you an SMS, please check your phone!')
+    in_error = email.get('error',
+        'We could not reach you by SMS, please get in touch with us!')
 
     # creates notifier object with NEXMO and MAIL details
     notify = Notify(sender=sender,
@@ -291,18 +748,21 @@ if __name__ == "__main__":
                     smtp_server=smtp_server,
                     smtp_port=smtp_port)
 
-    # command line override sets only one client
-    if args.destination is None:
-        notify.parser(destination)
-    else:
-        notify.clients.append(Client('CMD', 'Line',
-                                      args.destination,
-                                      args.email))
-
-    # send out notifications to clients
-    if not args.skip_sms:
-        notify.push_sms(notify.build_simple_sms(sms_content))
-    notify.send_email_confirmation(subject, in_success, in_error)
-
-    # for reference
-    notify.print_response()
\ No newline at end of file
+    try:
+        # command line override sets only one client
+        if args.destination is None:
+            notify.parser(destination)
+        else:
+            notify.clients.append(Client('CMD', 'Line',
+                                          args.destination,
+                                          args.email))
+
+        # send out notifications to clients
+        if not args.skip_sms:
+            notify.push_sms(notify.build_simple_sms(sms_content))
+        notify.send_email_confirmation(subject, in_success, in_error)
+
+        # for reference
+        notify.print_response()
+    finally:
+        notify.close()
\ No newline at end of file